@@ -1,32 +1,28 @@
 import os
+import re
 import time
 import logging
 import hashlib
 import hmac
 import base64
-from decimal import Decimal, InvalidOperation
+import functools
+import asyncio
+from decimal import Decimal
 from urllib.parse import urlencode
-from threading import Thread
 from dotenv import load_dotenv
-from flask import Flask
 import aiohttp
+import orjson
+import uvloop
+from aiohttp import web
+from cachetools import TTLCache
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackContext, MessageHandler, filters, CallbackQueryHandler
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 
 # Load environment variables
 load_dotenv()
 
-# Flask app for health checks
-app = Flask(__name__)
-
-@app.route('/')
-def home():
-    return "Bot is running"
-
-def run_flask():
-    app.run(host='0.0.0.0', port=80)
-
 # Environment variables
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 # TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN_DEV")
@@ -35,39 +31,100 @@ API_SEC_KRAKEN = os.getenv('KRAKEN_API_SECRET')
 RUST_BACKEND_URL = os.getenv("RUST_BACKEND_URL")
 MONGO_URI = os.getenv("MONGO_URI")
 
+# Key the Kraken HMAC once; each signature copies the pre-keyed state
+KRAKEN_HMAC = hmac.new(base64.b64decode(API_SEC_KRAKEN), None, 'sha512') if API_SEC_KRAKEN else None
+
 # Logging configuration
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
+for noisy_logger in ("aiohttp.client", "httpx", "telegram.ext"):
+    logging.getLogger(noisy_logger).setLevel(logging.WARNING)
 
 # Initialize MongoDB client
-mongo_client = MongoClient(MONGO_URI)
+mongo_client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=50,
+    minPoolSize=10,
+    maxIdleTimeMS=10000,
+    serverSelectionTimeoutMS=5000,
+)
 db = mongo_client['telegram_bot']
 users_collection = db['users']
 transactions_collection = db['transactions']
 
+# Short-lived cache of projected user documents keyed by Telegram user id
+USER_DOC_FIELDS = {"_id": 0, "autobuy_amount": 1, "solana_public_key": 1, "api_key": 1}
+user_doc_cache = TTLCache(maxsize=10_000, ttl=30)
+user_doc_cache_lock = asyncio.Lock()
+
+async def get_user_doc(uid):
+    async with user_doc_cache_lock:
+        doc = user_doc_cache.get(uid)
+    if doc is not None:
+        return doc
+    doc = await users_collection.find_one({"user_id": uid}, USER_DOC_FIELDS)
+    if doc is not None:
+        async with user_doc_cache_lock:
+            user_doc_cache[uid] = doc
+    return doc
+
+async def invalidate_user_doc(uid):
+    async with user_doc_cache_lock:
+        user_doc_cache.pop(uid, None)
+
 MIN_BTC_AMOUNT = Decimal('0.0001')
 MAX_BTC_AMOUNT = Decimal('1')
+SATS_PER_BTC = 100_000_000
+MIN_SATS = 10_000
+MAX_SATS = 100_000_000
+BTC_AMOUNT_RE = re.compile(r'^(?:0|[1-9]\d?)(?:\.\d{1,8})?$')
 API_URL = "https://api.kraken.com"
-
-def get_kraken_signature(uri_path, data, api_sec):
-    postdata = urlencode(data)
-    encoded = (str(data['nonce']) + postdata).encode()
-    message = uri_path.encode() + hashlib.sha256(encoded).digest()
-    mac = hmac.new(base64.b64decode(api_sec), message, hashlib.sha512)
+DEPOSIT_ADDRESSES_URI = b'/0/private/DepositAddresses'
+
+# The menu buttons never change, so build the markup once
+MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Lockin", callback_data='lockin')],
+    [InlineKeyboardButton("Export Key", callback_data='export_key')],
+    [InlineKeyboardButton("Autobuy Settings", callback_data='autobuy_settings')]
+])
+
+# Shared HTTP session, opened in post_init and closed in post_shutdown
+HTTP_SESSION: aiohttp.ClientSession = None
+# Health check server, served from the bot's own event loop
+HEALTH_RUNNER: web.AppRunner = None
+
+def parse_btc_amount(amount_text):
+    """Parse a BTC amount into satoshis, or return None if it is malformed."""
+    amount_text = amount_text.strip()
+    if not BTC_AMOUNT_RE.match(amount_text):
+        return None
+    whole, _, frac = amount_text.partition('.')
+    return int(whole) * SATS_PER_BTC + int(frac.ljust(8, '0'))
+
+def format_btc(sats):
+    return f"{sats // SATS_PER_BTC}.{sats % SATS_PER_BTC:08d}"
+
+def get_kraken_signature(uri_path, nonce, postdata, api_hmac):
+    encoded = nonce.encode() + postdata.encode()
+    message = uri_path + hashlib.sha256(encoded).digest()
+    mac = api_hmac.copy()
+    mac.update(message)
     return base64.b64encode(mac.digest()).decode()
 
-async def kraken_request(uri_path, data, api_key, api_sec):
+async def kraken_request(uri_path, data, api_key, api_hmac):
+    # Encode the body once and send the exact bytes that were signed
+    postdata = urlencode(data)
     headers = {
         'API-Key': api_key,
-        'API-Sign': get_kraken_signature(uri_path, data, api_sec)
+        'API-Sign': get_kraken_signature(uri_path, data['nonce'], postdata, api_hmac),
+        'Content-Type': 'application/x-www-form-urlencoded',
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_URL + uri_path, headers=headers, data=data) as response:
-                response.raise_for_status()
-                return await response.json()
+        async with HTTP_SESSION.post(API_URL + uri_path.decode(), headers=headers, data=postdata) as response:
+            response.raise_for_status()
+            return orjson.loads(await response.read())
     except aiohttp.ClientError as e:
-        logger.error(f"Kraken request error: {e}")
+        logger.error("Kraken request error: %s", e)
         return {"error": [str(e)]}
 
 def get_user(update: Update):
@@ -77,16 +134,29 @@ def get_user(update: Update):
         return update.callback_query.from_user
     return None
 
+def requires_registered(handler):
+    """Resolve the user and their cached document before calling handler."""
+    # Callback handlers pass the user explicitly; message handlers only get the update
+    @functools.wraps(handler)
+    async def wrapper(update, context: CallbackContext, user=None):
+        if user is None:
+            user = get_user(update)
+        if not user:
+            await update.message.reply_text("Error: Unable to retrieve user information.")
+            return
+        existing_user = await get_user_doc(user.id)
+        if existing_user is None:
+            await update.message.reply_text("You are not registered. Please register first using /start.")
+            return
+        return await handler(update, context, user, existing_user)
+    return wrapper
+
 async def start(update: Update, context: CallbackContext):
     user = get_user(update)
     if not user:
         await update.message.reply_text("Error: Unable to retrieve user information.")
         return
 
-    if users_collection.find_one({"user_id": user.id}):
-        await update.message.reply_text("You are already registered. Use /menu to see more options.")
-        return
-
     user_data = {
         "user_id": user.id,
         "username": user.username,
@@ -96,174 +166,163 @@ async def start(update: Update, context: CallbackContext):
         "lockin_total": 0,
         "autobuy_amount": None
     }
-    users_collection.insert_one(user_data)
+    try:
+        await users_collection.insert_one(user_data)
+    except DuplicateKeyError:
+        await update.message.reply_text("You are already registered. Use /menu to see more options.")
+        return
+
+    # The backend looks up the inserted user before generating wallets, so this call must follow the insert
     headers = {'Content-Type': 'application/json'}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{RUST_BACKEND_URL}/register", json={"user_id": user.id}, headers=headers) as req:
+    registered = False
+    try:
+        async with HTTP_SESSION.post(f"{RUST_BACKEND_URL}/register", data=orjson.dumps({"user_id": user.id}), headers=headers) as req:
             if req.status == 200:
-                await update.message.reply_text("Registration successful! Use /menu to see more options.")
+                registered = True
             else:
-                logger.error(f"Failed to register user with Rust backend: {await req.text()}")
-                await update.message.reply_text("Registration failed. Please try again later.")
+                logger.error("Failed to register user with Rust backend: %s", await req.text())
+    except aiohttp.ClientError as e:
+        logger.error("Rust backend request error: %s", e)
 
-async def lockin(update: Update, context: CallbackContext, user):
-    existing_user = users_collection.find_one({"user_id": user.id})
-    if not user:
-        await update.message.reply_text("You are not registered. Please register first using /start.")
-        return
+    if not registered:
+        # Roll back the insert so the user can retry /start
+        await users_collection.delete_one({"user_id": user.id})
+    # The backend rewrites the user document with generated keys
+    await invalidate_user_doc(user.id)
+
+    if registered:
+        await update.message.reply_text("Registration successful! Use /menu to see more options.")
+    else:
+        await update.message.reply_text("Registration failed. Please try again later.")
+
+@requires_registered
+async def lockin(update: Update, context: CallbackContext, user, existing_user):
     autobuy_amount = existing_user.get("autobuy_amount")
     
     if autobuy_amount is None:
-        print('SHOULD ASK FOR AMOUNT')
+        logger.debug("No autobuy amount for user %s, asking for one", user.id)
         await update.message.reply_text("Please enter the amount of BTC you want to lock in (minimum 0.0001 BTC, maximum 1 BTC):")
         context.user_data["handler"] = handle_btc_amount
     else:
-        print(autobuy_amount)
-        await create_deposit_address(update, context, user, autobuy_amount)
+        logger.debug("Using autobuy amount %s for user %s", autobuy_amount, user.id)
+        # Autobuy is stored as a BTC float for the backend's user schema
+        await create_deposit_address(update, context, user, round(autobuy_amount * SATS_PER_BTC))
         
 
-async def create_deposit_address(update: Update, context: CallbackContext, user, amount: Decimal):
+async def create_deposit_address(update: Update, context: CallbackContext, user, sats: int):
     try:
         deposit_response = await kraken_request(
-            '/0/private/DepositAddresses', {
-                "nonce": str(int(1000 * time.time())),
+            DEPOSIT_ADDRESSES_URI, {
+                "nonce": str(time.time_ns() // 1_000_000),
                 "asset": "XXBT",
                 "method": "Bitcoin Lightning",
                 "new": True,
-                "amount": float(amount),
-            }, API_KEY_KRAKEN, API_SEC_KRAKEN)
+                "amount": format_btc(sats),
+            }, API_KEY_KRAKEN, KRAKEN_HMAC)
 
         if 'error' in deposit_response and deposit_response['error']:
-            logger.error(f"Kraken deposit address error: {deposit_response['error']}")
+            logger.error("Kraken deposit address error: %s", deposit_response['error'])
             await update.message.reply_text("Error generating deposit address. Please try again later.")
             return
 
         kraken_deposit_address = deposit_response['result'][0]['address']
         transaction = {
             "user_id": user.id,
-            "amount": float(amount),
+            "amount_sats": sats,
             "processed": False,
             "status": "unofficial",
             "address": kraken_deposit_address,
             "timestamp": time.time(),
         }
-        transactions_collection.insert_one(transaction)
+        await transactions_collection.insert_one(transaction)
 
         await update.message.reply_text(
-            f"Transaction recorded.\nPlease send {amount} BTC to the following address:\n\n<code>{kraken_deposit_address}</code>",
+            f"Transaction recorded.\nPlease send {format_btc(sats)} BTC to the following address:\n\n<code>{kraken_deposit_address}</code>",
             parse_mode="HTML")
     except Exception as e:
-        logger.error(f"Error creating deposit address: {e}")
+        logger.error("Error creating deposit address: %s", e)
         await update.message.reply_text("An error occurred. Please try again later.")
 
-async def handle_btc_amount(update: Update, context: CallbackContext):
-    user = get_user(update)
-    if not user:
-        await update.message.reply_text("Error: Unable to retrieve user information.")
-        return
-
+@requires_registered
+async def handle_btc_amount(update: Update, context: CallbackContext, user, existing_user):
     amount_text = update.message.text
     try:
-        amount = Decimal(amount_text)
-        if amount < MIN_BTC_AMOUNT or amount > MAX_BTC_AMOUNT:
+        sats = parse_btc_amount(amount_text)
+        if sats is None:
+            logger.error("Invalid amount format: %s", amount_text)
+            await update.message.reply_text("Invalid amount format. Please enter a numeric value.")
+            return
+        if sats < MIN_SATS or sats > MAX_SATS:
             await update.message.reply_text(f"Invalid amount. Please enter an amount between {MIN_BTC_AMOUNT} and {MAX_BTC_AMOUNT} BTC.")
             return
-
-        await create_deposit_address(update, context, user, amount)
-    except InvalidOperation:
-        logger.error(f"Invalid amount format: {amount_text}")
-        await update.message.reply_text("Invalid amount format. Please enter a numeric value.")
+        await create_deposit_address(update, context, user, sats)
     except Exception as e:
-        logger.error(f"Error handling BTC amount: {e}")
+        logger.error("Error handling BTC amount: %s", e)
         await update.message.reply_text("An error occurred. Please try again later.")
 
-async def show_menu(update: Update, context: CallbackContext):
-    user = get_user(update)
-    if not user:
-        await update.message.reply_text("Error: Unable to retrieve user information.")
-        return
-    existing_user = users_collection.find_one({"user_id": user.id})
-    if not existing_user:
-        await update.message.reply_text("You are not registered. Please register first using /start.")
-        return
-
-    keyboard = [
-        [InlineKeyboardButton("Lockin", callback_data='lockin')],
-        [InlineKeyboardButton("Export Key", callback_data='export_key')],
-        [InlineKeyboardButton("Autobuy Settings", callback_data='autobuy_settings')]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
+@requires_registered
+async def show_menu(update: Update, context: CallbackContext, user, existing_user):
     welcome_message = f"Welcome, {user.username}!\n\nSolana Receive Address: {existing_user.get('solana_public_key', 'Not set')}\n\n"
-    await update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    await update.message.reply_text(welcome_message, reply_markup=MENU_MARKUP)
 
 async def button(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
 
     user = query.from_user
-    logger.info(f"Button pressed by user: {user.id}, callback data: {query.data}")
+    logger.info("Button pressed by user: %s, callback data: %s", user.id, query.data)
 
-    if query.data == 'lockin':
-        await lockin(query, context, user)
-    elif query.data == 'export_key':
-        await export_key(query, context, user)
-    elif query.data == 'autobuy_settings':
-        await set_autobuy_amount(query, context, user)
-
-async def set_autobuy_amount(update: Update, context: CallbackContext, user):
-    if not user:
-        await update.message.reply_text("Error: Unable to retrieve user information.")
-        return
-
-    if not users_collection.find_one({"user_id": user.id}):
-        await update.message.reply_text("You are not registered. Please register first using /start.")
-        return
+    handler = BUTTON_HANDLERS.get(query.data)
+    if handler:
+        await handler(query, context, user)
+    else:
+        logger.warning("Unknown callback data: %s", query.data)
 
+@requires_registered
+async def set_autobuy_amount(update: Update, context: CallbackContext, user, existing_user):
     await update.message.reply_text("Please enter the amount of BTC for Autobuy (minimum 0.0001 BTC, maximum 1 BTC):")
     context.user_data["handler"] = save_autobuy_amount
 
-async def save_autobuy_amount(update: Update, context: CallbackContext):
-    user = get_user(update)
-    if not user:
-        await update.message.reply_text("Error: Unable to retrieve user information.")
-        return
-
+@requires_registered
+async def save_autobuy_amount(update: Update, context: CallbackContext, user, existing_user):
     amount_text = update.message.text
     try:
-        amount = Decimal(amount_text)
-        if amount < MIN_BTC_AMOUNT or amount > MAX_BTC_AMOUNT:
+        sats = parse_btc_amount(amount_text)
+        if sats is None:
+            logger.error("Invalid amount format: %s", amount_text)
+            await update.message.reply_text("Invalid amount format. Please enter a numeric value.")
+            return
+        if sats < MIN_SATS or sats > MAX_SATS:
             await update.message.reply_text(f"Invalid amount. Please enter an amount between {MIN_BTC_AMOUNT} and {MAX_BTC_AMOUNT} BTC.")
             return
-
-        users_collection.update_one({"user_id": user.id}, {"$set": {"autobuy_amount": float(amount)}})
-        await update.message.reply_text(f"Autobuy amount set to {amount} BTC.")
-    except InvalidOperation:
-        logger.error(f"Invalid amount format: {amount_text}")
-        await update.message.reply_text("Invalid amount format. Please enter a numeric value.")
+        result = await users_collection.update_one({"user_id": user.id}, {"$set": {"autobuy_amount": sats / SATS_PER_BTC}})
+        await invalidate_user_doc(user.id)
+        if result.matched_count == 0:
+            await update.message.reply_text("You are not registered. Please register first using /start.")
+            return
+        await update.message.reply_text(f"Autobuy amount set to {format_btc(sats)} BTC.")
     except Exception as e:
-        logger.error(f"Error saving Autobuy amount: {e}")
+        logger.error("Error saving Autobuy amount: %s", e)
         await update.message.reply_text("An error occurred. Please try again later.")
 
-async def export_key(update: Update, context: CallbackContext, user):
-    if not user:
-        await update.message.reply_text("Error: Unable to retrieve user information.")
-        return
-
-    existing_user = users_collection.find_one({"user_id": user.id})
-    if not existing_user:
-        await update.message.reply_text("You are not registered. Please register first using /start.")
-        return
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{RUST_BACKEND_URL}/decrypt_keys", json={"api_key": existing_user['api_key']}) as response:
-            if response.status == 200:
-                data = await response.json()
-                solana_private_key = data.get('solana', {}).get('private_key')
-                await update.message.reply_text(f"Your Solana Private Key:\n<code>{solana_private_key}</code>\n", parse_mode="HTML")
-            else:
-                logger.error(f"Failed to export key: {await response.text()}")
-                await update.message.reply_text("Failed to export key. Please try again later.")
+@requires_registered
+async def export_key(update: Update, context: CallbackContext, user, existing_user):
+    headers = {'Content-Type': 'application/json'}
+    async with HTTP_SESSION.get(f"{RUST_BACKEND_URL}/decrypt_keys", data=orjson.dumps({"api_key": existing_user['api_key']}), headers=headers) as response:
+        if response.status == 200:
+            data = orjson.loads(await response.read())
+            solana_private_key = data.get('solana', {}).get('private_key')
+            await update.message.reply_text(f"Your Solana Private Key:\n<code>{solana_private_key}</code>\n", parse_mode="HTML")
+        else:
+            logger.error("Failed to export key: %s", await response.text())
+            await update.message.reply_text("Failed to export key. Please try again later.")
+
+# Maps menu callback data to the handler for that button
+BUTTON_HANDLERS = {
+    'lockin': lockin,
+    'export_key': export_key,
+    'autobuy_settings': set_autobuy_amount,
+}
 
 async def handle_user_message(update: Update, context: CallbackContext):
     handler = context.user_data.get("handler")
@@ -273,11 +332,32 @@ async def handle_user_message(update: Update, context: CallbackContext):
     else:
         await update.message.reply_text("Please use the /menu to navigate the bot options.")
 
+async def home(request: web.Request):
+    return web.Response(text="Bot is running")
+
+async def post_init(application: Application):
+    global HTTP_SESSION, HEALTH_RUNNER
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=60)
+    HTTP_SESSION = aiohttp.ClientSession(connector=connector)
+    await users_collection.create_index("user_id", unique=True)
+    await transactions_collection.create_index([("user_id", 1), ("timestamp", -1)])
+
+    health_app = web.Application()
+    health_app.router.add_get('/', home)
+    HEALTH_RUNNER = web.AppRunner(health_app)
+    await HEALTH_RUNNER.setup()
+    await web.TCPSite(HEALTH_RUNNER, '0.0.0.0', 80).start()
+
+async def post_shutdown(application: Application):
+    if HTTP_SESSION is not None:
+        await HTTP_SESSION.close()
+    if HEALTH_RUNNER is not None:
+        await HEALTH_RUNNER.cleanup()
+
 def main():
-    # Start Flask app in a separate thread
-    Thread(target=run_flask).start()
+    uvloop.install()
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("menu", show_menu))
     application.add_handler(CallbackQueryHandler(button))